@@ -1,15 +1,20 @@
 import os
 import sys
 import codecs
-import requests
-import psycopg2
-import json
+import aiohttp
+import asyncpg
+from redis import asyncio as aioredis
+import orjson
 import asyncio
 import random
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+import time
+import functools
+from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, MenuButtonCommands
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 import dotenv
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 # Установка UTF-8 для вывода
 if sys.stdout.encoding != 'utf-8':
@@ -18,12 +23,16 @@ if sys.stdout.encoding != 'utf-8':
 # Отключаем подробные логи httpx
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-# Настройка логирования
+# Настройка логирования: запись в stdout идёт в отдельном потоке через очередь,
+# чтобы не блокировать цикл событий
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logger.handlers = [handler]
+log_queue = queue.SimpleQueue()
+logger.handlers = [QueueHandler(log_queue)]
+log_listener = QueueListener(log_queue, handler)
+log_listener.start()
 
 # Загрузка переменных из .env
 dotenv.load_dotenv()
@@ -33,6 +42,19 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Время жизни прогноза в кэше Redis, секунды
+FORECAST_CACHE_TTL = 600
+
+# Ограничение частоты: не больше RATE_LIMIT сообщений за RATE_LIMIT_WINDOW секунд
+RATE_LIMIT = 5
+RATE_LIMIT_WINDOW = 10
+RATE_LIMIT_MESSAGE = "Слишком много запросов, подождите немного."
+
+# Время жизни и размер кэша в памяти для редко меняющихся данных пользователя
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 10000
 
 # Главное меню (InlineKeyboardMarkup)
 MAIN_KEYBOARD = InlineKeyboardMarkup([
@@ -51,10 +73,23 @@ GAMES_KEYBOARD = InlineKeyboardMarkup([
 # Загрузка списка городов
 try:
     with open("cities.txt", "r", encoding="utf-8") as f:
-        VALID_CITIES = set(line.strip().lower() for line in f)
+        VALID_CITIES = frozenset(sys.intern(line.strip().lower()) for line in f if line.strip())
 except FileNotFoundError:
     logger.error("Файл cities.txt не найден!")
-    VALID_CITIES = set()
+    VALID_CITIES = frozenset()
+
+# Индекс городов по первой букве для хода бота
+CITIES_BY_LETTER = {}
+for c in VALID_CITIES:
+    CITIES_BY_LETTER.setdefault(c[0], []).append(c)
+CITIES_BY_LETTER = {letter: tuple(cities) for letter, cities in CITIES_BY_LETTER.items()}
+
+# Буквы, на которые город не может начинаться
+_TRIM = 'ьъ'
+
+def _last_playable_letter(city):
+    # Последняя буква города без 'ь' и 'ъ' на конце
+    return city.rstrip(_TRIM)[-1:]
 
 # Квест
 QUEST_STAGES = [
@@ -70,524 +105,682 @@ LOGIC_RIDDLES = [
     {"riddle": "У меня есть города, но нет домов. Что я?", "answer": "карта"}
 ]
 
-# Инициализация базы данных
-def init_db():
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS weather_requests (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                city TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS favorite_cities (
-                user_id BIGINT,
-                city TEXT,
-                PRIMARY KEY (user_id, city)
-            );
-            CREATE TABLE IF NOT EXISTS game_progress (
-                user_id BIGINT PRIMARY KEY,
-                game_name TEXT,
-                score INTEGER DEFAULT 0,
-                state JSONB DEFAULT '{}'
-            );
-            CREATE TABLE IF NOT EXISTS user_achievements (
-                user_id BIGINT,
-                achievement TEXT,
-                PRIMARY KEY (user_id, achievement)
-            );
-            CREATE TABLE IF NOT EXISTS user_stars (
-                user_id BIGINT PRIMARY KEY,
-                stars INTEGER DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS game_results (
-                user_id BIGINT,
-                game_name TEXT,
-                score INTEGER,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка инициализации базы данных: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def log_weather_request(user_id, city):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO weather_requests (user_id, city) VALUES (%s, %s)", (user_id, city))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при логировании запроса погоды: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def save_favorite_city(user_id, city):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO favorite_cities (user_id, city) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, city))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении любимого города: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def get_favorite_city(user_id):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT city FROM favorite_cities WHERE user_id = %s LIMIT 1", (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
-    except Exception as e:
-        logger.error(f"Ошибка при получении любимого города: {e}")
-        return None
-    finally:
-        cursor.close()
-        conn.close()
-
-def start_game(user_id, game_name):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO game_progress (user_id, game_name, score, state) VALUES (%s, %s, 0, %s) ON CONFLICT (user_id) DO UPDATE SET game_name = %s, score = 0, state = %s", 
-                       (user_id, game_name, '{}', game_name, '{}'))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при старте игры: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def update_game_state(user_id, score, state):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE game_progress SET score = %s, state = %s WHERE user_id = %s", (score, json.dumps(state), user_id))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении состояния игры: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def get_game_state(user_id):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT game_name, score, state FROM game_progress WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-        return result if result else (None, 0, '{}')
-    except Exception as e:
-        logger.error(f"Ошибка при получении состояния игры: {e}")
-        return (None, 0, '{}')
-    finally:
-        cursor.close()
-        conn.close()
-
-def award_achievement(user_id, achievement):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO user_achievements (user_id, achievement) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, achievement))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при выдаче достижения: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+# Достижения за 100 очков в играх: название и эмодзи
+ACHIEVEMENT_SCORE = 100
+ACHIEVEMENT_STARS = 10
+ACHIEVEMENT_STICKER = "CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME"
+AWARDS = {
+    "Cities": ("Мастер городов", "🏙️"),
+    "Guess": ("Мастер угадывания", "🎲"),
+    "Quest": ("Мастер приключений", "🗺️"),
+    "Logic": ("Мастер логики", "🧩"),
+}
+
+# Пул соединений с базой данных (создаётся в init_db)
+DB_POOL_MIN = 2
+DB_POOL_MAX = min(20, int(os.getenv('DB_POOL_MAX', '10')))
+# Кэш подготовленных запросов на соединение (0 — для pgbouncer в режиме transaction)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+db_pool = None
+
+# Клиент Redis для кэша (создаётся в post_init, если задан REDIS_URL)
+redis_client = None
+
+async def init_connection(conn):
+    # JSONB приходит и уходит как dict, сериализация через orjson
+    await conn.set_type_codec('jsonb', encoder=lambda value: orjson.dumps(value).decode(), decoder=orjson.loads, schema='pg_catalog')
 
-def get_stars(user_id):
+# Инициализация базы данных
+async def init_db():
+    global db_pool
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT stars FROM user_stars WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-        if not result:
-            cursor.execute("INSERT INTO user_stars (user_id, stars) VALUES (%s, 0)", (user_id,))
-            conn.commit()
-            result = (0,)
-        return result[0]
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            # Размер пула не больше четверти от max_connections сервера
+            max_connections = int(await conn.fetchval("SHOW max_connections"))
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS weather_requests (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT,
+                    city TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS favorite_cities (
+                    user_id BIGINT,
+                    city TEXT,
+                    PRIMARY KEY (user_id, city)
+                );
+                CREATE TABLE IF NOT EXISTS game_progress (
+                    user_id BIGINT PRIMARY KEY,
+                    game_name TEXT,
+                    score INTEGER DEFAULT 0,
+                    state JSONB DEFAULT '{}'
+                );
+                CREATE TABLE IF NOT EXISTS user_achievements (
+                    user_id BIGINT,
+                    achievement TEXT,
+                    PRIMARY KEY (user_id, achievement)
+                );
+                CREATE TABLE IF NOT EXISTS user_stars (
+                    user_id BIGINT PRIMARY KEY,
+                    stars INTEGER DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS game_results (
+                    user_id BIGINT,
+                    game_name TEXT,
+                    score INTEGER,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                -- Таблицы только дополняются: выборки по пользователю через B-tree,
+                -- по времени через компактный BRIN
+                CREATE INDEX IF NOT EXISTS ix_weather_user_ts ON weather_requests (user_id, timestamp DESC);
+                CREATE INDEX IF NOT EXISTS ix_weather_ts ON weather_requests USING BRIN (timestamp);
+                CREATE INDEX IF NOT EXISTS ix_results_user_game_ts ON game_results (user_id, game_name, timestamp DESC);
+                CREATE INDEX IF NOT EXISTS ix_results_ts ON game_results USING BRIN (timestamp)
+            ''')
+        finally:
+            await conn.close()
+        pool_max = max(DB_POOL_MIN, min(DB_POOL_MAX, max_connections // 4))
+        # asyncpg готовит каждый запрос один раз на соединение; max_cached_statement_lifetime=0
+        # не даёт кэшу сбрасывать планы каждые 5 минут
+        db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=DB_POOL_MIN, max_size=pool_max, init=init_connection,
+                                            statement_cache_size=DB_STATEMENT_CACHE_SIZE, max_cached_statement_lifetime=0)
+        logger.info("Пул соединений с базой данных создан: %s-%s", DB_POOL_MIN, pool_max)
     except Exception as e:
-        logger.error(f"Ошибка при получении звёзд: {e}")
+        logger.error("Ошибка инициализации базы данных: %s", e)
+
+# Возвращается функциями под user_cache при ошибке базы данных, чтобы
+# сбой не попадал в кэш
+DB_ERROR = object()
+
+def user_cache(default=None):
+    # Кэширует результат корутины по user_id на USER_CACHE_TTL секунд.
+    # DB_ERROR не кэшируется и заменяется на default.
+    # При изменении данных нужно вызвать func.cache_invalidate(user_id).
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        async def wrapper(user_id):
+            now = time.monotonic()
+            cached = cache.get(user_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+            value = await func(user_id)
+            if value is DB_ERROR:
+                return default
+            cache.pop(user_id, None)
+            if len(cache) >= USER_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+            cache[user_id] = (now + USER_CACHE_TTL, value)
+            return value
+
+        wrapper.cache_invalidate = lambda user_id: cache.pop(user_id, None)
+        return wrapper
+    return decorator
+
+def db_call(error_message, default=None):
+    # Выдаёт функции соединение из пула первым аргументом; при ошибке пишет
+    # в лог error_message и возвращает default
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                async with db_pool.acquire() as conn:
+                    return await func(conn, *args, **kwargs)
+            except Exception as e:
+                logger.error("%s: %s", error_message, e)
+                return default
+        return wrapper
+    return decorator
+
+@db_call("Ошибка при логировании запроса погоды")
+async def log_weather_request(conn, user_id, city):
+    await conn.execute("INSERT INTO weather_requests (user_id, city) VALUES ($1, $2)", user_id, city)
+
+@db_call("Ошибка при сохранении любимого города")
+async def save_favorite_city(conn, user_id, city):
+    await conn.execute("INSERT INTO favorite_cities (user_id, city) VALUES ($1, $2) ON CONFLICT DO NOTHING", user_id, city)
+    get_favorite_city.cache_invalidate(user_id)
+
+@user_cache()
+@db_call("Ошибка при получении любимого города", default=DB_ERROR)
+async def get_favorite_city(conn, user_id):
+    return await conn.fetchval("SELECT city FROM favorite_cities WHERE user_id = $1 LIMIT 1", user_id)
+
+# Состояние для game_progress.state: очки и имя игры лежат в отдельных столбцах
+def _stored_state(game_state):
+    return {k: v for k, v in game_state.items() if k not in ("game", "score")}
+
+@db_call("Ошибка при старте игры")
+async def start_game(conn, user_id, game_name, state=None):
+    # Начальное состояние записывается тем же запросом, что и сброс прогресса
+    await conn.execute("INSERT INTO game_progress (user_id, game_name, score, state) VALUES ($1, $2, 0, $3) ON CONFLICT (user_id) DO UPDATE SET game_name = $2, score = 0, state = $3",
+                       user_id, game_name, _stored_state(state or {}))
+
+@db_call("Ошибка при получении состояния игры", default=(None, 0, {}))
+async def get_game_state(conn, user_id):
+    result = await conn.fetchrow("SELECT game_name, score, state FROM game_progress WHERE user_id = $1", user_id)
+    return tuple(result) if result else (None, 0, {})
+
+@db_call("Ошибка при получении звёзд", default=0)
+async def get_stars(conn, user_id):
+    stars = await conn.fetchval("SELECT stars FROM user_stars WHERE user_id = $1", user_id)
+    if stars is None:
+        await conn.execute("INSERT INTO user_stars (user_id, stars) VALUES ($1, 0) ON CONFLICT DO NOTHING", user_id)
+        stars = 0
+    return stars
+
+@db_call("Ошибка при сохранении хода игры")
+async def record_turn(conn, user_id, game_name, score, state_patch, achievement=None, stars=0, new_cities=None, finished=False):
+    # Состояние игры, результат, достижение и звёзды записываются одним запросом.
+    # В state передаются только изменённые ключи, new_cities дописываются в used_cities на сервере.
+    # Результат в game_results сохраняется только по окончании игры (finished=True).
+    await conn.execute('''
+        WITH progress AS (
+            UPDATE game_progress
+            SET score = $3,
+                state = CASE WHEN $7::text[] IS NULL THEN state || $4::jsonb
+                             ELSE jsonb_set(state || $4::jsonb, '{used_cities}',
+                                            COALESCE(state->'used_cities', '[]'::jsonb) || to_jsonb($7::text[]))
+                        END
+            WHERE user_id = $1
+        ), result AS (
+            INSERT INTO game_results (user_id, game_name, score)
+            SELECT $1, $2, $3 WHERE $8::boolean
+        ), achievement AS (
+            INSERT INTO user_achievements (user_id, achievement)
+            SELECT $1, $5::text WHERE $5::text IS NOT NULL
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO user_stars (user_id, stars)
+        SELECT $1, $6::int WHERE $6::int > 0
+        ON CONFLICT (user_id) DO UPDATE SET stars = user_stars.stars + EXCLUDED.stars
+    ''', user_id, game_name, score, state_patch, achievement, stars, new_cities, finished)
+
+@db_call("Ошибка при сохранении итогов игры")
+async def finish_game(conn, user_id, game_name, score, state, achievement=None, stars=0):
+    # Для игр, чьё состояние хранится в context.user_data: прогресс, результат,
+    # достижение и звёзды записываются одним запросом по окончании игры
+    await conn.execute('''
+        WITH progress AS (
+            INSERT INTO game_progress (user_id, game_name, score, state) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO UPDATE SET game_name = EXCLUDED.game_name, score = EXCLUDED.score, state = EXCLUDED.state
+        ), result AS (
+            INSERT INTO game_results (user_id, game_name, score) VALUES ($1, $2, $3)
+        ), achievement AS (
+            INSERT INTO user_achievements (user_id, achievement)
+            SELECT $1, $5::text WHERE $5::text IS NOT NULL
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO user_stars (user_id, stars)
+        SELECT $1, $6::int WHERE $6::int > 0
+        ON CONFLICT (user_id) DO UPDATE SET stars = user_stars.stars + EXCLUDED.stars
+    ''', user_id, game_name, score, _stored_state(state), achievement, stars)
+
+@db_call("Ошибка при сохранении итогов игры")
+async def close_game(conn, user_id, game_name):
+    # Для игр, чьё состояние хранится в базе (Города): результат брошенной игры
+    # переносится из game_progress в game_results
+    await conn.execute("INSERT INTO game_results (user_id, game_name, score) SELECT user_id, game_name, score FROM game_progress WHERE user_id = $1 AND game_name = $2",
+                       user_id, game_name)
+
+# Счётчик запросов пользователя в текущем окне (0, если Redis недоступен)
+async def count_request(user_id):
+    if redis_client is None:
         return 0
-    finally:
-        cursor.close()
-        conn.close()
-
-def update_stars(user_id, amount):
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO user_stars (user_id, stars) VALUES (%s, %s) ON CONFLICT (user_id) DO UPDATE SET stars = user_stars.stars + %s", 
-                       (user_id, amount, amount))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении звёзд: {e}")
-    finally:
-        cursor.close()
-        conn.close()
-
-def save_game_result(user_id, game_name, score):
+    key = f"rl:{user_id}"
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO game_results (user_id, game_name, score) VALUES (%s, %s, %s)", (user_id, game_name, score))
-        conn.commit()
+        # Ключ создаётся сразу с TTL (SET NX EX), затем INCR в той же транзакции:
+        # ключ не может остаться без TTL, и работает на любой версии Redis
+        async with redis_client.pipeline(transaction=True) as pipe:
+            _, count = await pipe.set(key, 0, ex=RATE_LIMIT_WINDOW, nx=True).incr(key).execute()
+        return count
     except Exception as e:
-        logger.error(f"Ошибка при сохранении результата игры: {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        logger.warning("Не удалось проверить ограничение частоты: %s", e)
+        return 0
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Привет! Я простой бот. Выбери опцию:", reply_markup=MAIN_KEYBOARD)
 
 # Функция для прогноза на 5 дней
-def get_forecast(city):
-    url = f"http://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
+async def get_forecast(city, session):
+    # В кэше лежат только строки прогноза: заголовок с городом собирается
+    # для каждого запроса, чтобы не отдавать чужое написание названия
+    city = city.strip()
+    header = f"Прогноз на 5 дней в {city}:\n"
+    cache_key = f"wx:{city.lower()}"
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(cache_key)
+            if cached:
+                return header + cached.decode()
+        except Exception as e:
+            logger.warning("Не удалось прочитать прогноз из кэша: %s", e)
+
+    url = "http://api.openweathermap.org/data/2.5/forecast"
+    params = {"q": city, "appid": WEATHER_API_KEY, "units": "metric", "lang": "ru"}
     try:
-        response = requests.get(url)
-        data = response.json()
+        async with session.get(url, params=params) as response:
+            data = await response.json(content_type=None)
         if data["cod"] == "200":
-            forecast_text = f"Прогноз на 5 дней в {city}:\n"
-            daily_data = {}
-            for entry in data["list"]:
-                date = entry["dt_txt"].split(" ")[0]
-                if date not in daily_data and "12:00:00" in entry["dt_txt"]:
-                    temp = entry["main"]["temp"]
-                    desc = entry["weather"][0]["description"]
-                    daily_data[date] = f"{date}: {temp}°C, {desc}"
-            forecast_text += "\n".join(daily_data.values())
-            return forecast_text
+            # По одной записи на день — прогноз на 12:00
+            lines = [f'{entry["dt_txt"][:10]}: {entry["main"]["temp"]}°C, {entry["weather"][0]["description"]}'
+                     for entry in data["list"] if entry["dt_txt"].endswith(" 12:00:00")]
+            forecast_lines = "\n".join(lines)
+            if redis_client is not None:
+                try:
+                    await redis_client.setex(cache_key, FORECAST_CACHE_TTL, forecast_lines)
+                except Exception as e:
+                    logger.warning("Не удалось сохранить прогноз в кэш: %s", e)
+            return header + forecast_lines
         else:
             return "Не удалось найти город для прогноза."
     except Exception as e:
-        logger.error(f"Ошибка при запросе прогноза: {e}")
+        logger.error("Ошибка при запросе прогноза: %s", e)
         return "Произошла ошибка при получении прогноза."
 
+# Завершение игры: сбрасываем ожидание ответа и состояние игры в памяти
+def end_game(context):
+    context.user_data["awaiting_game"] = False
+    context.user_data.pop("game_state", None)
+
+# Сохранение незавершённой игры с набранными очками: игры из context.user_data
+# записываются под именем из game_state["game"], Города — через close_game
+async def save_pending_game(context, user_id):
+    game_state = context.user_data.pop("game_state", None)
+    if game_state is not None:
+        await finish_game(user_id, game_state["game"], game_state["score"], game_state)
+    elif context.user_data.get("awaiting_game") == "Cities":
+        await close_game(user_id, "Cities")
+    context.user_data["awaiting_game"] = False
+
+# Выход в меню: незавершённая игра сохраняется, пользовательские данные очищаются
+async def leave_game(context, user_id):
+    await save_pending_game(context, user_id)
+    context.user_data.clear()
+
+# Выдача достижения: запись итогов, стикер и сообщение отправляются одновременно.
+# save(achievement=..., stars=...) сохраняет итоги игры (record_turn или finish_game).
+# Игра завершается до отправки: ошибка Telegram не должна оставить игру активной
+# и привести к повторному начислению звёзд.
+async def grant(update, context, game_name, score, text, save):
+    achievement, emoji = AWARDS[game_name]
+    end_game(context)
+    results = await asyncio.gather(
+        save(achievement=achievement, stars=ACHIEVEMENT_STARS),
+        context.bot.send_sticker(chat_id=update.message.chat_id, sticker=ACHIEVEMENT_STICKER),
+        update.message.reply_text(f"{text}Достижение '{achievement}' ({emoji}) получено! Очки: {score}", reply_markup=MAIN_KEYBOARD),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Ошибка при отправке достижения: %s", result)
+
 # Обработка текстовых сообщений
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
     user_id = update.message.from_user.id
 
+    request_count = await count_request(user_id)
+    if request_count > RATE_LIMIT:
+        # Предупреждаем только о первом отклонённом сообщении в окне
+        if request_count == RATE_LIMIT + 1:
+            await update.message.reply_text(RATE_LIMIT_MESSAGE)
+        return
+
     if text == "Меню":
-        logger.info(f"Пользователь {user_id} вернулся в главное меню")
+        logger.info("Пользователь %s вернулся в главное меню", user_id)
         await update.message.reply_text("Вы вернулись в главное меню:", reply_markup=MAIN_KEYBOARD)
-        context.user_data.clear()
+        await leave_game(context, user_id)
         return
 
     if context.user_data.get("awaiting_city"):
         city = text.strip()
-        forecast_info = get_forecast(city)
+        forecast_info = await get_forecast(city, context.bot_data["http"])
         weather_keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("⭐ Сохранить как любимый", callback_data=f"save_city_{city}")]
         ])
-        await update.message.reply_text(forecast_info, reply_markup=weather_keyboard)
-        log_weather_request(user_id, city)
+        await asyncio.gather(
+            update.message.reply_text(forecast_info, reply_markup=weather_keyboard),
+            log_weather_request(user_id, city),
+        )
         context.user_data["awaiting_city"] = False
 
     elif context.user_data.get("awaiting_game") == "Cities":
         city = text.strip().lower()
-        game_name, score, state = get_game_state(user_id)
+        game_name, score, state = await get_game_state(user_id)
         if game_name != "Cities":
             await update.message.reply_text("Вы не играете в 'Города' сейчас.", reply_markup=MAIN_KEYBOARD)
-            context.user_data["awaiting_game"] = False
+            end_game(context)
             return
-        state = json.loads(state) if isinstance(state, str) else state
         last_city = state.get("last_city", "")
-        used_cities = state.get("used_cities", [])
+        used = set(state.get("used_cities", []))
 
         if city not in VALID_CITIES:
             await update.message.reply_text("Неверный город или его нет в списке. Назови другой город или напиши 'Меню' для выхода.")
             return
-        elif city in used_cities:
+        elif city in used:
             await update.message.reply_text("Этот город уже был назван! Назови другой город или напиши 'Меню' для выхода.")
             return
         
-        # Определяем последнюю играющую букву, исключая 'ь' и 'ъ'
-        last_letter = last_city
-        while last_letter and last_letter[-1] in 'ьъ':
-            last_letter = last_letter[:-1]
-        last_letter = last_letter[-1] if last_letter else ''
+        last_letter = _last_playable_letter(last_city)
 
         if last_city and city[0] != last_letter:
             await update.message.reply_text(f"Город должен начинаться с буквы '{last_letter.upper()}'. Назови другой город или напиши 'Меню' для выхода.")
             return
         else:
             score += 10
-            used_cities.append(city)
-            # Определяем последнюю играющую букву нового города
-            next_letter = city
-            while next_letter and next_letter[-1] in 'ьъ':
-                next_letter = next_letter[:-1]
-            next_letter = next_letter[-1] if next_letter else ''
-            
-            available_cities = [c for c in VALID_CITIES if c.startswith(next_letter) and c not in used_cities]
+            used.add(city)
+            next_letter = _last_playable_letter(city)
+            available_cities = [c for c in CITIES_BY_LETTER.get(next_letter, ()) if c not in used]
             bot_city = random.choice(available_cities) if available_cities else None
             if bot_city:
-                used_cities.append(bot_city)
-                state["last_city"] = bot_city
-                state["used_cities"] = used_cities
-                update_game_state(user_id, score, state)
-                save_game_result(user_id, "Cities", score)
-                if score >= 100:
-                    award_achievement(user_id, "Мастер городов")
-                    await context.bot.send_sticker(chat_id=update.message.chat_id, sticker="CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME")
-                    await update.message.reply_text(f"Правильно! Бот: {bot_city.capitalize()}\nДостижение 'Мастер городов' (🏙️) получено! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                    update_stars(user_id, 10)
-                    context.user_data["awaiting_game"] = False
+                state_patch = {"last_city": bot_city}
+                if score >= ACHIEVEMENT_SCORE:
+                    await grant(update, context, "Cities", score, f"Правильно! Бот: {bot_city.capitalize()}\n",
+                                functools.partial(record_turn, user_id, "Cities", score, state_patch, new_cities=[city, bot_city], finished=True))
                 else:
+                    await record_turn(user_id, "Cities", score, state_patch, new_cities=[city, bot_city])
                     await update.message.reply_text(f"Правильно! Бот: {bot_city.capitalize()}\nОчки: {score}. Назови следующий город:")
             else:
-                save_game_result(user_id, "Cities", score)
-                await update.message.reply_text(f"Правильно, но я не нашёл города на '{next_letter.upper()}'. Ты победил! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                if score >= 100:
-                    award_achievement(user_id, "Мастер городов")
-                    await context.bot.send_sticker(chat_id=update.message.chat_id, sticker="CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME")
-                    update_stars(user_id, 10)
-                context.user_data["awaiting_game"] = False
+                win_text = f"Правильно, но я не нашёл города на '{next_letter.upper()}'. Ты победил! "
+                if score >= ACHIEVEMENT_SCORE:
+                    await grant(update, context, "Cities", score, win_text,
+                                functools.partial(record_turn, user_id, "Cities", score, {}, new_cities=[city], finished=True))
+                else:
+                    await record_turn(user_id, "Cities", score, {}, new_cities=[city], finished=True)
+                    await update.message.reply_text(f"{win_text}Очки: {score}", reply_markup=MAIN_KEYBOARD)
+                    end_game(context)
 
     elif context.user_data.get("awaiting_game") == "Guess":
         try:
             guess = int(text.strip())
-            game_name, score, state = get_game_state(user_id)
-            if game_name != "Guess":
+            game_state = context.user_data.get("game_state")
+            if game_state is None:
                 await update.message.reply_text("Вы не играете в 'Угадай число' сейчас.", reply_markup=MAIN_KEYBOARD)
-                context.user_data["awaiting_game"] = False
+                end_game(context)
                 return
-            state = json.loads(state) if isinstance(state, str) else state
-            target = state.get("target")
-            attempts = state.get("attempts", 0) + 1
-
-            if guess == target:
-                score += 10
-                state["attempts"] = attempts
-                update_game_state(user_id, score, state)
-                save_game_result(user_id, "Guess", score)
-                if score >= 100:
-                    award_achievement(user_id, "Мастер угадывания")
-                    await context.bot.send_sticker(chat_id=update.message.chat_id, sticker="CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME")
-                    await update.message.reply_text(f"Угадал с {attempts} попытки! Достижение 'Мастер угадывания' (🎲) получено! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                    update_stars(user_id, 10)
-                    context.user_data["awaiting_game"] = False
+            game_state["attempts"] += 1
+            attempts = game_state["attempts"]
+
+            if guess == game_state["target"]:
+                game_state["score"] += 10
+                score = game_state["score"]
+                if score >= ACHIEVEMENT_SCORE:
+                    await grant(update, context, "Guess", score, f"Угадал с {attempts} попытки! ",
+                                functools.partial(finish_game, user_id, "Guess", score, game_state))
                 else:
-                    state["target"] = random.randint(1, 100)
-                    state["attempts"] = 0
-                    update_game_state(user_id, score, state)
+                    game_state["target"] = random.randint(1, 100)
+                    game_state["attempts"] = 0
                     await update.message.reply_text(f"Угадал с {attempts} попытки! Очки: {score}. Я загадал новое число от 1 до 100. Угадай:")
-            elif guess < target:
-                state["attempts"] = attempts
-                update_game_state(user_id, score, state)
+            elif guess < game_state["target"]:
                 await update.message.reply_text("Моё число больше. Попробуй ещё:")
             else:
-                state["attempts"] = attempts
-                update_game_state(user_id, score, state)
                 await update.message.reply_text("Моё число меньше. Попробуй ещё:")
         except ValueError:
             await update.message.reply_text("Введи число от 1 до 100! Или напиши 'Меню' для выхода.")
 
     elif context.user_data.get("awaiting_game") == "Quest":
-        game_name, score, state = get_game_state(user_id)
-        if game_name != "Quest":
+        game_state = context.user_data.get("game_state")
+        if game_state is None:
             await update.message.reply_text("Вы не играете в 'Квест' сейчас.", reply_markup=MAIN_KEYBOARD)
-            context.user_data["awaiting_game"] = False
+            end_game(context)
             return
-        state = json.loads(state) if isinstance(state, str) else state
-        stage = state.get("stage", 0)
+        stage = game_state["stage"]
         if text.lower() in ["вперёд", "да"] and stage < len(QUEST_STAGES):
-            score += 10
-            state["stage"] = stage + 1
-            update_game_state(user_id, score, state)
-            save_game_result(user_id, "Quest", score)
+            game_state["score"] += 10
+            game_state["stage"] = stage + 1
+            score = game_state["score"]
             if stage + 1 >= len(QUEST_STAGES):
-                if score >= 100:
-                    award_achievement(user_id, "Мастер приключений")
-                    await context.bot.send_sticker(chat_id=update.message.chat_id, sticker="CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME")
-                    await update.message.reply_text(f"Ты прошёл квест! Достижение 'Мастер приключений' (🗺️) получено! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                    update_stars(user_id, 10)
+                if score >= ACHIEVEMENT_SCORE:
+                    await grant(update, context, "Quest", score, "Ты прошёл квест! ",
+                                functools.partial(finish_game, user_id, "Quest", score, game_state))
                 else:
+                    await finish_game(user_id, "Quest", score, game_state)
                     await update.message.reply_text(f"Ты прошёл квест! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                context.user_data["awaiting_game"] = False
+                    end_game(context)
             else:
                 await update.message.reply_text(QUEST_STAGES[stage + 1])
         else:
-            save_game_result(user_id, "Quest", score)
+            await finish_game(user_id, "Quest", game_state["score"], game_state)
             await update.message.reply_text("Неверный выбор, квест провален!", reply_markup=MAIN_KEYBOARD)
-            context.user_data["awaiting_game"] = False
+            end_game(context)
 
     elif context.user_data.get("awaiting_game") == "Logic":
-        game_name, score, state = get_game_state(user_id)
-        if game_name != "Logic":
+        game_state = context.user_data.get("game_state")
+        if game_state is None:
             await update.message.reply_text("Вы не играете в 'Логику' сейчас.", reply_markup=MAIN_KEYBOARD)
-            context.user_data["awaiting_game"] = False
+            end_game(context)
             return
-        state = json.loads(state) if isinstance(state, str) else state
-        riddle_idx = state.get("riddle_idx", 0)
-        riddle = LOGIC_RIDDLES[riddle_idx]
+        riddle = LOGIC_RIDDLES[game_state["riddle_idx"]]
         if text.strip().lower() == riddle["answer"]:
-            score += 10
-            riddle_idx = (riddle_idx + 1) % len(LOGIC_RIDDLES)
-            state["riddle_idx"] = riddle_idx
-            update_game_state(user_id, score, state)
-            save_game_result(user_id, "Logic", score)
-            if score >= 100:
-                award_achievement(user_id, "Мастер логики")
-                await context.bot.send_sticker(chat_id=update.message.chat_id, sticker="CAACAgIAAxkBAAEKDhJk2Xh-RpP8uN8GLgG8o8nK0oW6rwAC5y0AAp8oyEmQ8eL5oIElbjME")
-                await update.message.reply_text(f"Правильно! Достижение 'Мастер логики' (🧩) получено! Очки: {score}", reply_markup=MAIN_KEYBOARD)
-                update_stars(user_id, 10)
-                context.user_data["awaiting_game"] = False
+            game_state["score"] += 10
+            game_state["riddle_idx"] = (game_state["riddle_idx"] + 1) % len(LOGIC_RIDDLES)
+            score = game_state["score"]
+            if score >= ACHIEVEMENT_SCORE:
+                await grant(update, context, "Logic", score, "Правильно! ",
+                            functools.partial(finish_game, user_id, "Logic", score, game_state))
             else:
-                await update.message.reply_text(f"Правильно! Очки: {score}\n{LOGIC_RIDDLES[riddle_idx]['riddle']}")
+                await update.message.reply_text(f"Правильно! Очки: {score}\n{LOGIC_RIDDLES[game_state['riddle_idx']]['riddle']}")
         else:
-            save_game_result(user_id, "Logic", score)
+            await finish_game(user_id, "Logic", game_state["score"], game_state)
             await update.message.reply_text(f"Неверно! Правильный ответ: {riddle['answer']}. Игра окончена.", reply_markup=MAIN_KEYBOARD)
-            context.user_data["awaiting_game"] = False
+            end_game(context)
+
+async def cb_weather(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    current_text = query.message.text
+    if current_text != "Введите название города для прогноза на 5 дней:":
+        await asyncio.gather(
+            query.edit_message_text("Введите название города для прогноза на 5 дней:"),
+            query.message.reply_text("Введи город:"),
+        )
+    context.user_data["awaiting_city"] = True
+
+async def cb_admin(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    if current_text != "Вы направили запрос Администратору.":
+        username = query.from_user.username
+        message = f'Пользователь <a href="tg://user?id={user_id}">@{username or user_id}</a> запросил связь с админом!'
+        await asyncio.gather(
+            query.edit_message_text("Вы направили запрос Администратору.", reply_markup=MAIN_KEYBOARD),
+            context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=message, parse_mode='HTML'),
+        )
+
+async def cb_favorite_weather(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    current_markup = query.message.reply_markup
+    city = await get_favorite_city(user_id)
+    if city:
+        forecast_info = await get_forecast(city, context.bot_data["http"])
+        if current_text != forecast_info or current_markup != MAIN_KEYBOARD:
+            await query.edit_message_text(forecast_info, reply_markup=MAIN_KEYBOARD)
+    else:
+        if current_text != "У вас нет любимого города. Введите город для прогноза:":
+            await asyncio.gather(
+                query.edit_message_text("У вас нет любимого города. Введите город для прогноза:"),
+                query.message.reply_text("Введи город:"),
+            )
+        context.user_data["awaiting_city"] = True
+
+async def cb_save_city(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    city = query.data[len("save_city_"):]
+    await save_favorite_city(user_id, city)
+    if current_text != f"Город {city} сохранён как любимый!":
+        await query.edit_message_text(f"Город {city} сохранён как любимый!", reply_markup=MAIN_KEYBOARD)
+
+async def cb_play(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    current_text = query.message.text
+    current_markup = query.message.reply_markup
+    if current_text != "Выбери игру:" or current_markup != GAMES_KEYBOARD:
+        await query.edit_message_text("Выбери игру:", reply_markup=GAMES_KEYBOARD)
+
+async def cb_game_cities(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    await save_pending_game(context, user_id)
+    await start_game(user_id, "Cities")
+    if current_text != "Игра 'Города' началась! Назови первый город:":
+        await asyncio.gather(
+            query.edit_message_text("Игра 'Города' началась! Назови первый город:"),
+            query.message.reply_text("Назови город:"),
+        )
+    context.user_data["awaiting_game"] = "Cities"
+
+async def cb_game_guess(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    await save_pending_game(context, user_id)
+    context.user_data["game_state"] = {"game": "Guess", "score": 0, "target": random.randint(1, 100), "attempts": 0}
+    await start_game(user_id, "Guess", context.user_data["game_state"])
+    if current_text != "Я загадал число от 1 до 100. Угадай:":
+        await asyncio.gather(
+            query.edit_message_text("Я загадал число от 1 до 100. Угадай:"),
+            query.message.reply_text("Введи число:"),
+        )
+    context.user_data["awaiting_game"] = "Guess"
+
+async def cb_game_quest(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    await save_pending_game(context, user_id)
+    context.user_data["game_state"] = {"game": "Quest", "score": 0, "stage": 0}
+    await start_game(user_id, "Quest", context.user_data["game_state"])
+    if current_text != QUEST_STAGES[0]:
+        await asyncio.gather(
+            query.edit_message_text(QUEST_STAGES[0]),
+            query.message.reply_text("Введи ответ:"),
+        )
+    context.user_data["awaiting_game"] = "Quest"
+
+async def cb_game_logic(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    await save_pending_game(context, user_id)
+    context.user_data["game_state"] = {"game": "Logic", "score": 0, "riddle_idx": 0}
+    await start_game(user_id, "Logic", context.user_data["game_state"])
+    if current_text != LOGIC_RIDDLES[0]["riddle"]:
+        await asyncio.gather(
+            query.edit_message_text(LOGIC_RIDDLES[0]["riddle"]),
+            query.message.reply_text("Введи ответ:"),
+        )
+    context.user_data["awaiting_game"] = "Logic"
+
+async def cb_main(query: CallbackQuery, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = query.from_user.id
+    current_text = query.message.text
+    current_markup = query.message.reply_markup
+    if current_text != "Вы вернулись в главное меню:" or current_markup != MAIN_KEYBOARD:
+        await query.edit_message_text("Вы вернулись в главное меню:", reply_markup=MAIN_KEYBOARD)
+    await leave_game(context, user_id)
+
+# Обработчики callback-запросов: точное совпадение query.data и префиксы
+CB_HANDLERS = {
+    "weather": cb_weather,
+    "admin": cb_admin,
+    "favorite_weather": cb_favorite_weather,
+    "play": cb_play,
+    "game_cities": cb_game_cities,
+    "game_guess": cb_game_guess,
+    "game_quest": cb_game_quest,
+    "game_logic": cb_game_logic,
+    "main": cb_main,
+}
+CB_PREFIXES = (
+    ("save_city_", cb_save_city),
+)
 
 # Обработка callback-запросов
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
 
+    if await count_request(user_id) > RATE_LIMIT:
+        try:
+            await query.answer(RATE_LIMIT_MESSAGE)
+        except Exception as e:
+            logger.warning("Не удалось ответить на callback-запрос %s: %s", query.id, e)
+        return
+
     try:
         await query.answer()
     except Exception as e:
-        logger.warning(f"Не удалось ответить на callback-запрос {query.id}: {e}")
-
-    current_text = query.message.text
-    current_markup = query.message.reply_markup
+        logger.warning("Не удалось ответить на callback-запрос %s: %s", query.id, e)
+
+    logger.info("Callback от %s: %s", user_id, query.data)
+
+    cb = CB_HANDLERS.get(query.data)
+    if cb is None:
+        cb = next((h for prefix, h in CB_PREFIXES if query.data.startswith(prefix)), None)
+    if cb is not None:
+        await cb(query, context)
+
+# Команда для демонстрации платёжной системы
+async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(f"Демонстрация платежа с использованием PROVIDER_TOKEN: {PROVIDER_TOKEN[:5]}...", reply_markup=MAIN_KEYBOARD)
+
+# Обработка ошибок
+async def error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.error("Произошла ошибка: %s", context.error)
+    error_message = "Произошла ошибка, попробуйте позже."
+    if isinstance(update, Update):
+        if update.message:  # Для обычных сообщений
+            logger.info("Ошибка в сообщении, отправляем ответ с MAIN_KEYBOARD")
+            await update.message.reply_text(error_message, reply_markup=MAIN_KEYBOARD)
+        elif update.callback_query:  # Для callback-запросов
+            query = update.callback_query
+            if query.message.text != error_message:
+                logger.info("Ошибка в callback, редактируем сообщение с MAIN_KEYBOARD")
+                await query.edit_message_text(error_message, reply_markup=MAIN_KEYBOARD)
+
+async def post_init(application: Application) -> None:
+    global redis_client
+    await init_db()
+    if REDIS_URL:
+        redis_client = aioredis.Redis.from_url(REDIS_URL)
+    # Общая HTTP-сессия: соединения к OpenWeather переиспользуются между запросами
+    application.bot_data["http"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=50, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=5),
+    )
+    # Настройка кнопки меню для вызова команд
+    await application.bot.set_chat_menu_button(menu_button=MenuButtonCommands())
+
+async def post_shutdown(application: Application) -> None:
+    http_session = application.bot_data.get("http")
+    if http_session is not None:
+        await http_session.close()
+    if db_pool is not None:
+        await db_pool.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+# Команда /menu, отображает главное меню
+async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("Вы открыли главное меню:", reply_markup=MAIN_KEYBOARD)
+
+def main() -> None:
+    application = Application.builder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("pay", pay))
+    application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_error_handler(error)
+
+    print("Бот запущен!")
+    print(f"Подключение к базе данных: {(DATABASE_URL or '')[:13]}... (скрыто для безопасности)")
 
-    logger.info(f"Callback от {user_id}: {query.data}")
-
-    if query.data == "weather":
-        if current_text != "Введите название города для прогноза на 5 дней:":
-            await query.edit_message_text("Введите название города для прогноза на 5 дней:")
-            await query.message.reply_text("Введи город:")
-        context.user_data["awaiting_city"] = True
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    finally:
+        # Дописываем оставшиеся в очереди записи лога даже при падении
+        log_listener.stop()
 
-    elif query.data == "admin":
-        if current_text != "Вы направили запрос Администратору.":
-            await query.edit_message_text("Вы направили запрос Администратору.", reply_markup=MAIN_KEYBOARD)
-            username = query.from_user.username
-            message = f'Пользователь <a href="tg://user?id={user_id}">@{username or user_id}</a> запросил связь с админом!'
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=message, parse_mode='HTML')
-
-    elif query.data == "favorite_weather":
-        city = get_favorite_city(user_id)
-        if city:
-            forecast_info = get_forecast(city)
-            if current_text != forecast_info or current_markup != MAIN_KEYBOARD:
-                await query.edit_message_text(forecast_info, reply_markup=MAIN_KEYBOARD)
-        else:
-            if current_text != "У вас нет любимого города. Введите город для прогноза:":
-                await query.edit_message_text("У вас нет любимого города. Введите город для прогноза:")
-                await query.message.reply_text("Введи город:")
-            context.user_data["awaiting_city"] = True
-
-    elif query.data.startswith("save_city_"):
-        city = query.data.split("_")[2]
-        save_favorite_city(user_id, city)
-        if current_text != f"Город {city} сохранён как любимый!":
-            await query.edit_message_text(f"Город {city} сохранён как любимый!", reply_markup=MAIN_KEYBOARD)
-
-    elif query.data == "play":
-        if current_text != "Выбери игру:" or current_markup != GAMES_KEYBOARD:
-            await query.edit_message_text("Выбери игру:", reply_markup=GAMES_KEYBOARD)
-
-    elif query.data == "game_cities":
-        start_game(user_id, "Cities")
-        if current_text != "Игра 'Города' началась! Назови первый город:":
-            await query.edit_message_text("Игра 'Города' началась! Назови первый город:")
-            await query.message.reply_text("Назови город:")
-        context.user_data["awaiting_game"] = "Cities"
-
-    elif query.data == "game_guess":
-        start_game(user_id, "Guess")
-        target = random.randint(1, 100)
-        state = {"target": target, "attempts": 0}
-        update_game_state(user_id, 0, state)
-        if current_text != "Я загадал число от 1 до 100. Угадай:":
-            await query.edit_message_text("Я загадал число от 1 до 100. Угадай:")
-            await query.message.reply_text("Введи число:")
-        context.user_data["awaiting_game"] = "Guess"
-
-    elif query.data == "game_quest":
-        start_game(user_id, "Quest")
-        state = {"stage": 0}
-        update_game_state(user_id, 0, state)
-        if current_text != QUEST_STAGES[0]:
-            await query.edit_message_text(QUEST_STAGES[0])
-            await query.message.reply_text("Введи ответ:")
- контекст.пользователь_данные["ожидание_игры"] = "Квест"контекст.пользователь_данные["ожидание_игры"] = "Квест"
-
- элиф запрос.данные == "игра_логика":элиф запрос.данные == "игра_логика":
- start_igrarastart_game(user_id, "Логика")(user_id, "Логика")
- государство = { "загадка_idx": 0}государство = { "загадка_idx": 0}
- obnovlеniе_game_stateupdate_game_state(user_id, 0, костойяни)(user_id, 0, костойяни)
- если теку итерий_текст!= LOGIC_RIDDLES[0]["загадка"]:teku iteriyiy_tecst!= LOGIC_RIDDLES[0]["загадка"]:
- запрос jdaty.edit_message_text(ЛОГИКА_ЗАГАДКИ[0]["загадка])jdaty query.edit_message_text(LOGIC_RIDDLES[0]["загадка])
- запрос jdem.сообщение.ответить_text("Введиответ:")запрос jdem.сообщение.ответить_text("Введиответ:")
- контекст.пользователь_данные["ожидание_игры"] = "Логика"контекст.пользователь_данные["ожидание_игры"] = "Логика"
-
- элиф запрос.данные == "основой":элиф запрос.данные == "основой":
- если теку итерий_текст!= "Вы вернулись в главное:" ili tekuyiy_markup!= MAIN_KEYBOARD:если теку итерий_текст!= "Вы вернулись в главное мне:" ili tekuyiy_markup != MAIN_KEYBOARD:
- jdem query.edit_message_text("Вы вёрь: главное:", responte_markup=MAIN_KEYBOARD)jdem query.edit_message_text("Вы вёрнус в глявно:", responte_markup=MAIN_KEYBOARD)jdem query.edit_message_text("Вы вёрнус в клявно:", responte_markupMAIN_KEYBOARD)
- контекст.user_data.clear()context.user_data.clear()
-
-#Команда dlia demostracii plelégewsie sistemys
-async def pay (obnovlennie: Obnovléniе, kontecst: ContextTypes.DEFAULT_TYPE) -> Нет:
- dodojdatiсya update.message.reply_text(f"Demonstracia platega сo ispollzovaniem PROVIDER_TOKEN: {PROVIDER_TOKEN[:5]}...", responte_markup=MAIN_KEYBOARD)dodojdatiсya update.message.reply_text(f"Demonstracia platega сospollzovaniem PROVIDER_TOKEN:{PROVIDER_TOKEN[:5]}...", responte_markup=MAIN_KEYBOARD)
-
-#Обработка ошибок
-oshibka Async def (obnovlеniе: Обновление, конец: ContextTypes.DEFAULT_TYPE) -> Нет:
- logger.error (f'Proizooshla oshibka: {context.error}')logger.error (f'Proizooshla oshibka: {context.error}')
- error_message = "Proizoshlа oshibka, poprobuyte pozgе."error_message = "Proizoshlа oshibka, poprobuyte popzgesh."
- если обновленные не обсудят: если обновленные не обсудят:
- esli update.message: #Для обычных с обениеслы update.message: #Для обычных с обени
- logger.info ("Ошибка в обинах, отправлёт ответе с MAIN_KEYBOARD")logger.info ("Ошибка в собинах, отправлёт ответ ветве с MAIN_KEYBOARD")
- dodojdatiсya update.message.reply_text(error_message, reple_markup=MAIN_KEYBOARD)dodojdatiсya update.message.reply_text(error_message, reple_markup=MAIN_KEYBOARD)
- elif update.callback_query: #Для обратного звонок-запросовелиф update.callback_query: #Для обратного звонок-запросов
- zaproс = update.callback_queryzaproс = update.callback_query
- если query.message.text!= error_message:ecli query.message.text!= error_message:
- logger.info("Ошибка в обратном вызове, reretaktiruеm sobeniе с MAIN_KEYBOARD")logger.info("Ошибка в обратном вызове, reretaktiruеm sobeniе с MAIN_KEYBOARD")
- ogjidaniе query.edit_message_text(error_message, replete_markup=MAIN_KEYBOARD)ogjidaniе query.edit_message_text(error_message, replete_markup=MAIN_KEYBOARD)
-
-async def post_init (приложенье: Приложенье) -> Нет:
- #Настройка кнопки Мен-Для Вызова команд#Настройка кнопки Мен-Для Вызова команд
- prilogeniе Ojidaniе.bot.set_chat_menu_button(menu_button={"тип: "commands"})prilogeniе Ojidaniе.bot.set_chat_menu_button(menu_button={"тип: "commands"})
-
-asyncasync def post_init (приложенье: Приложенье) -> Net:def post_init (приложенье: Приложенье) -> Net:
- #Настройка кнопки Мен-Для Вызова команд#Настройка кнопки Мен-Для Вызова команд
- prilogeniе Ojidaniе.bot.set_chat_menu_button(menu_button={"тип: "команды"})bot.set_chat_menu_button(menu_button={"тип: "команды"})
-
-ménunus async def (obnovlеniе: Obnovlеniе, kontecst: ContextTypes.DEFAULT_TYPE) -> Нет:
- #Обрабочик Команды /menu∞, otobrarajaet glavnoe mugchiny#Обрабочик Команды /menu∞, otobrarajaet glavnoe mugchiny
- dodojdatiсya update.message.reply_text("Вы, отркрылы глевное:", responte_markup=MAIN_KEYBOARD)dodojdatiсya update.message.reply_text("Вы, отркрылы глевное мне:", responte_markup=MAIN_KEYBOARD)
-
-def main() -> Нет:
- init_db()init_db()
- prilogeniе = Application.builder().token(TOKEN).post_init(post_init).build()prilogeniе = Application.builder().token(TOKEN).post_init(post_init).build()
- application.add_handler(CommandHandler("zappuctitiсia", zappuctitiсcya))application.add_handler(CommandHandler("zappoustitliсia", zappucitliсia))
- application.add_handler(CommandHandler("плати", Platti))application.add_handler(CommandHandler("плати", Platti))
- application.add_handler(CommandHandler("menuly∞", mеnush)) #Novая Komandaapplication.add_handler(CommandHandler("menuly∞", menush)) #Новая Команда
- application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
- приложение.add_handler (CallbackQueryHandler (handle_callback))application.add_handler (CallbackQueryHandler (handle_callback))
- prilogeniе.add_error_handler(ошибка)prilogeniе.add_error_handler(ошибка)
-
- распечтат ("Bott zapu charletеn!".kodirovaty().decode('utf-8'))распечтат ("Bott zapu charletеn!".kodirovaty().decode('utf-8'))
- распочехаты(f"Podklulucheniе k babaze dannyх: {DATABASE_URL[:13]}... (screyt dlia bezogapatsnosti)".encode().decode('utf-8'))raspechechaty(f"Podklulucheniе k babaze dannyх: {DATABASE_URL[:13]}... (screyt dlia bezogapatsnosti)".encode().decode('utf-8'))
- распочехаты(f"Paroly babazy dannyх: {DB_PASSWORD[:0]}... (screyt dlya bezopasnocti)".kod().decode('utf-8'))raspechechaty(f"Paroly babazy dannyх: {DB_PASSWORD[:0]}... (screyt dlya bezopasnocti)".encode().decode('utf-8'))
-
- application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
-
-esli __name__ == '__main__':
- asyncio.run(glawnyy ()) #Запуск асинхроний функциц и черёз асинсио.runasyncio.run (glawnyy ()) #Запуск асинхроний функциц и черёз асинсио.run (glawnyyy ()) #Запуск асинсьо.run
+if __name__ == '__main__':
+    main()